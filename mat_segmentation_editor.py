@@ -1,92 +1,374 @@
 import sys
 import numpy as np
 import os
+import re
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QLabel, QPushButton, QListWidget, QListWidgetItem, QFileDialog,
                              QMessageBox, QGroupBox, QSplitter, QStatusBar)
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
 import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from scipy.io import loadmat, savemat
-
-# 设置中文显示
-plt.rcParams["font.family"] = ["SimHei", "WenQuanYi Micro Hei", "Heiti TC"]
-plt.rcParams["axes.unicode_minus"] = False  # 解决负号显示问题
+from scipy.io import loadmat, savemat, whosmat
+from scipy.io.matlab import matfile_version
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    from scipy.io.matlab._mio5 import MatFile5Reader
+    from scipy.io.matlab._mio5_params import MDTYPES, miCOMPRESSED, mxDOUBLE_CLASS, mxUINT64_CLASS
+    MMAP_AVAILABLE = True
+except ImportError:
+    try:
+        # 旧版scipy的模块路径
+        from scipy.io.matlab.mio5 import MatFile5Reader
+        from scipy.io.matlab.mio5_params import MDTYPES, miCOMPRESSED, mxDOUBLE_CLASS, mxUINT64_CLASS
+        MMAP_AVAILABLE = True
+    except ImportError:
+        MMAP_AVAILABLE = False
+
+try:
+    import hdf5storage
+    HDF5STORAGE_AVAILABLE = True
+except ImportError:
+    HDF5STORAGE_AVAILABLE = False
+
+# 超过该像素数且numba可用时，使用并行内核过滤类别
+NUMBA_MIN_SIZE = 1_000_000
+
+# 整数标签最大值低于该值时用bincount代替np.unique提取类别
+BINCOUNT_MAX_LABEL = 1 << 20
+
+# 掩码超过该字节数且hdf5storage可用时，以v7.3(HDF5)格式保存
+HDF5_MIN_NBYTES = 16 << 20
+
+# 显示时掩码长边的最大像素数，超过则降采样
+DISPLAY_MAX_SIDE = 800
+
+# 预先计算的viridis调色板(256x4 RGBA)，显示时直接查表，不经过matplotlib渲染
+PALETTE = (plt.get_cmap('viridis')(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+
+# v5文件中超过该字节数的未压缩数值矩阵使用内存映射
+MMAP_MIN_NBYTES = 1 << 20
+
+# v5矩阵数组标志中的复数/逻辑位
+MAT_COMPLEX_FLAG = 0x0800
+MAT_LOGICAL_FLAG = 0x0200
+
+# 可内存映射变量在文件中的位置；缓存中只保存该描述，取出时才创建映射
+_MappedArray = namedtuple('_MappedArray', ['dtype', 'offset', 'shape'])
+
+# 最近读取的MAT文件缓存：最多保留的文件数和总字节数，超过字节上限的文件不缓存
+MAT_CACHE_MAX_ENTRIES = 8
+MAT_CACHE_MAX_NBYTES = 256 << 20
+_mat_cache = OrderedDict()
+
+
+def _mat_major_version(path):
+    """MAT文件主版本号：0为v4，1为v5，2为v7.3(HDF5)"""
+    with open(path, 'rb') as f:
+        return matfile_version(f)[0]
+
+
+def _loadmat(path, variable_names=None):
+    # 大掩码会以v7.3(HDF5)格式保存，需用hdf5storage读取，保证编辑后的文件可以再次打开
+    if _mat_major_version(path) == 2:
+        if not HDF5STORAGE_AVAILABLE:
+            raise ValueError("v7.3(HDF5)格式的MAT文件需要安装hdf5storage才能读取")
+        if variable_names is not None:
+            variable_names = list(variable_names)
+        return hdf5storage.loadmat(path, variable_names=variable_names)
+    return loadmat(path, variable_names=variable_names, squeeze_me=False, struct_as_record=True)
+
+
+def _mmap_loadmat(path, variable_names=None):
+    """读取MAT文件；v5格式中未压缩的大型实数数值矩阵返回_MappedArray描述，其余变量正常读取"""
+    if not MMAP_AVAILABLE:
+        return _loadmat(path, variable_names)
+
+    # 只处理v5格式，v7.3(HDF5)和v4文件直接正常读取
+    if _mat_major_version(path) != 1:
+        return _loadmat(path, variable_names)
+
+    mapped = {}
+    var_order = []
+    with open(path, 'rb') as f:
+        reader = MatFile5Reader(f)
+        reader.initialize_read()
+        reader.read_file_header()
+        tag_dtype = np.dtype(reader.byte_order + 'u4')
+        data_dtypes = MDTYPES[reader.byte_order]['dtypes']
+
+        # 只读取变量头，按需记录数据在文件中的偏移
+        while not reader.end_of_stream():
+            # 未压缩变量：miMATRIX标签(8字节)后是数组标志元素的标签(8字节)和标志字
+            pos = f.tell()
+            tag_and_flags = np.frombuffer(f.read(20), dtype=tag_dtype)
+            compressed = tag_and_flags[0] == miCOMPRESSED
+            flags = int(tag_and_flags[4]) if len(tag_and_flags) == 5 else 0
+            f.seek(pos)
+            hdr, next_position = reader.read_var_header()
+            name = 'None' if hdr.name is None else hdr.name.decode('latin1')
+
+            if variable_names is None or name in variable_names:
+                var_order.append(name)
+                if (not compressed and mxDOUBLE_CLASS <= hdr.mclass <= mxUINT64_CLASS
+                        and not flags & (MAT_COMPLEX_FLAG | MAT_LOGICAL_FLAG)):
+                    # 实部数据元素的标签：(数据类型, 字节数)，高16位非0为小数据元素格式
+                    mdtype, nbytes = (int(v) for v in np.frombuffer(f.read(8), dtype=tag_dtype))
+                    dtype = data_dtypes.get(mdtype) if mdtype >> 16 == 0 else None
+                    shape = tuple(int(d) for d in hdr.dims)
+                    if (dtype is not None and nbytes >= MMAP_MIN_NBYTES
+                            and dtype.itemsize * int(np.prod(shape)) == nbytes):
+                        mapped[name] = _MappedArray(dtype, f.tell(), shape)
+
+            f.seek(next_position)
+
+    if not mapped:
+        return _loadmat(path, variable_names)
+
+    # 其余变量正常读取，并按文件中的顺序合并
+    loaded = _loadmat(path, [name for name in var_order if name not in mapped])
+    mat_data = {k: v for k, v in loaded.items() if k.startswith('__')}
+    for name in var_order:
+        if name in mapped:
+            mat_data[name] = mapped[name]
+        elif name in loaded:
+            mat_data[name] = loaded[name]
+    return mat_data
+
+
+def _mat_nbytes(value):
+    """估算加载结果占用的内存字节数（含cell和结构体中的数组）"""
+    if not isinstance(value, np.ndarray):
+        return 0
+    if value.dtype.names:
+        return sum(_mat_nbytes(value[name]) for name in value.dtype.names)
+    if value.dtype == object:
+        return value.nbytes + sum(_mat_nbytes(v) for v in value.flat)
+    return value.nbytes
+
+
+def cached_loadmat(path, variable_names=None):
+    """按(路径, 修改时间, 变量名)缓存最近读取的MAT文件，文件被修改后自动失效
+
+    返回的数据与缓存共享，调用方不得原地修改（保存时沿索引路径复制后再写入）
+    """
+    if variable_names is not None:
+        variable_names = tuple(variable_names)
+    key = (path, os.path.getmtime(path), variable_names)
+
+    cached = _mat_cache.get(key)
+    if cached is not None:
+        _mat_cache.move_to_end(key)
+        mat_data, _ = cached
+    else:
+        mat_data = _mmap_loadmat(path, variable_names)
+        nbytes = sum(_mat_nbytes(v) for v in mat_data.values())
+        if nbytes <= MAT_CACHE_MAX_NBYTES:
+            _mat_cache[key] = (mat_data, nbytes)
+            while (len(_mat_cache) > MAT_CACHE_MAX_ENTRIES
+                   or sum(n for _, n in _mat_cache.values()) > MAT_CACHE_MAX_NBYTES):
+                _mat_cache.popitem(last=False)
+
+    # 缓存中不持有映射（Windows下会占用文件），每次取出时重新创建只读映射
+    return {name: np.memmap(path, dtype=value.dtype, mode='r', offset=value.offset,
+                            shape=value.shape, order='F')
+            if isinstance(value, _MappedArray) else value
+            for name, value in mat_data.items()}
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _filter_mask_numba(mask, keep_lut, out):
+        """并行按查找表过滤类别：保留的标签原样写出，其余写0"""
+        for i in prange(mask.shape[0]):
+            label = mask[i]
+            out[i] = label if keep_lut[label] else 0
 
 
 class MatProcessor:
     """MAT文件处理工具类，沿用验证过的提取逻辑"""
 
+    # 加载后不可能被选为掩码的变量类型（cell为object数组，sparse不是ndarray）
+    NON_MASK_CLASSES = ('cell', 'sparse')
+    # SBD文件中分割掩码的固定索引路径：结构体[0, 0].Segmentation
+    SBD_LAYOUTS = (('GTinst', (0, 0), 'Segmentation'),
+                   ('GTcls', (0, 0), 'Segmentation'))
+    COMMON_SEGMENTATION_NAMES = ['segmentation', 'seg', 'mask', 'labels', 'gt']
+    _SEG_RE = re.compile('|'.join(COMMON_SEGMENTATION_NAMES), re.IGNORECASE)
+
+    @staticmethod
+    def load_candidates(file_path):
+        """只加载可能被选为分割掩码的变量，返回(数据, 是否已加载全部变量)
+
+        跳过的变量在两种提取方法中都不可能被选中，因此按文件顺序的选择结果与加载全部变量时一致
+        """
+        # whosmat不支持v7.3(HDF5)文件，直接完整读取
+        if _mat_major_version(file_path) == 2:
+            return cached_loadmat(file_path), True
+
+        # whosmat只读取变量头，开销很小
+        var_info = whosmat(file_path)
+        var_names = [name for name, _, _ in var_info]
+        candidates = [name for name, shape, mclass in var_info
+                      if mclass == 'struct'
+                      or (mclass not in MatProcessor.NON_MASK_CLASSES and len(shape) in [2, 3])]
+
+        if not candidates or len(candidates) == len(var_names):
+            return cached_loadmat(file_path), True
+        return cached_loadmat(file_path, variable_names=candidates), False
+
+    @staticmethod
+    def replace_at_path(obj, index_path, value):
+        """返回把obj中index_path处替换为value后的副本
+
+        路径上的dict和数组只做浅拷贝（不复制其余数据），结构体记录是所在数组副本的视图，直接写入
+        """
+        key = index_path[0]
+        if not isinstance(obj, np.void):
+            obj = obj.copy()
+        obj[key] = value if len(index_path) == 1 else \
+            MatProcessor.replace_at_path(obj[key], index_path[1:], value)
+        return obj
+
     @staticmethod
     def find_segmentation_mask(mat_data):
-        """尝试在MAT文件中查找分割掩码数据（沿用原代码）"""
-        common_segmentation_names = ['segmentation', 'seg', 'mask', 'labels', 'gt']
+        """尝试在MAT文件中查找分割掩码数据（沿用原代码），同时返回到达掩码的索引路径"""
+        seg_re = MatProcessor._SEG_RE
 
         for var_name, var_data in mat_data.items():
-            # 跳过MATLAB系统变量
-            if var_name.startswith('__'):
+            # 跳过MATLAB系统变量和非数组变量
+            if var_name.startswith('__') or not isinstance(var_data, np.ndarray):
                 continue
 
-            # 检查变量是否为数组
-            if isinstance(var_data, np.ndarray):
-                # 检查是否为结构化数组
-                if var_data.dtype.names:
-                    # 检查结构化数组的字段
-                    for field_name in var_data.dtype.names:
-                        if any(name in field_name.lower() for name in common_segmentation_names):
-                            try:
-                                field_data = var_data[field_name][0, 0]
-                                if isinstance(field_data, np.ndarray) and len(field_data.shape) in [2, 3]:
-                                    return field_data, f"{var_name}.{field_name}"
-                            except:
-                                continue
-                else:
-                    # 普通数组
-                    if len(var_data.shape) in [2, 3] and var_data.dtype != object:
-                        return var_data, var_name
-
-        return None, None
+            # 检查是否为结构化数组
+            if var_data.dtype.names:
+                # 只取一次记录，字段访问都基于该记录，避免重复构造结构化视图
+                try:
+                    rec = var_data[0, 0]
+                except:
+                    continue
+
+                # 检查结构化数组的字段
+                for field_name in var_data.dtype.names:
+                    if seg_re.search(field_name):
+                        field_data = rec[field_name]
+                        if isinstance(field_data, np.ndarray) and len(field_data.shape) in [2, 3]:
+                            return field_data, f"{var_name}.{field_name}", (var_name, (0, 0), field_name)
+            else:
+                # 普通数组
+                if len(var_data.shape) in [2, 3] and var_data.dtype != object:
+                    return var_data, var_name, (var_name,)
+
+        return None, None, None
 
     @staticmethod
     def custom_segmentation_processor(mat_data):
-        """自定义处理器，专门提取分割掩码（沿用原代码逻辑）"""
+        """自定义处理器，专门提取分割掩码（沿用原代码逻辑），同时返回到达掩码的索引路径"""
         try:
-            # 尝试标准SBD格式
-            if 'GTinst' in mat_data:
-                gt_data = mat_data['GTinst'][0, 0]
-                if 'Segmentation' in gt_data.dtype.names:
-                    seg_mask = gt_data['Segmentation'][0, 0]
-                    if isinstance(seg_mask, np.ndarray) and len(seg_mask.shape) in [2, 3]:
-                        return seg_mask, "GTinst.Segmentation"
-
-            # 尝试SBD的GTcls格式
-            if 'GTcls' in mat_data:
-                gt_data = mat_data['GTcls'][0, 0]
-                if 'Segmentation' in gt_data.dtype.names:
-                    seg_mask = gt_data['Segmentation'][0, 0]
-                    if isinstance(seg_mask, np.ndarray) and len(seg_mask.shape) in [2, 3]:
-                        return seg_mask, "GTcls.Segmentation"
+            # 尝试标准SBD格式(GTinst)和SBD的GTcls格式，按已知布局直接取值
+            for index_path in MatProcessor.SBD_LAYOUTS:
+                struct_name, rec_index, field_name = index_path
+                gt_struct = mat_data.get(struct_name)
+                if gt_struct is None or field_name not in gt_struct.dtype.fields:
+                    continue
+                seg_mask = gt_struct[rec_index][field_name]
+                # 字段为1x1的cell时再取一层
+                if isinstance(seg_mask, np.ndarray) and seg_mask.dtype == object and seg_mask.shape == (1, 1):
+                    seg_mask = seg_mask[0, 0]
+                    index_path = index_path + ((0, 0),)
+                if isinstance(seg_mask, np.ndarray) and len(seg_mask.shape) in [2, 3]:
+                    return seg_mask, f"{struct_name}.{field_name}", index_path
 
             # 尝试更简单的结构
             if 'segmentation' in mat_data:
                 seg_mask = mat_data['segmentation']
                 if isinstance(seg_mask, np.ndarray) and len(seg_mask.shape) in [2, 3]:
-                    return seg_mask, "segmentation"
+                    return seg_mask, "segmentation", ('segmentation',)
 
-            return None, None
+            return None, None, None
         except Exception as e:
             print(f"自定义处理器出错: {e}")
-            return None, None
+            return None, None, None
+
+    @staticmethod
+    def compact_labels(seg_mask):
+        """标签为非负整数且范围较小时压缩为uint8/uint16，减少内存和带宽占用"""
+        if seg_mask.dtype.kind not in 'iuf' or seg_mask.size == 0:
+            return seg_mask
+
+        min_val, max_val = seg_mask.min(), seg_mask.max()
+        if not min_val >= 0:
+            return seg_mask
+
+        for dtype in (np.uint8, np.uint16):
+            if max_val <= np.iinfo(dtype).max:
+                break
+        else:
+            return seg_mask
+
+        # 已经足够紧凑的整数类型无需转换
+        if seg_mask.dtype.kind in 'iu' and seg_mask.dtype.itemsize <= np.dtype(dtype).itemsize:
+            return seg_mask
+        # 浮点标签必须全为整数值才能无损转换
+        if seg_mask.dtype.kind == 'f' and not np.array_equal(seg_mask, np.trunc(seg_mask)):
+            return seg_mask
+
+        return seg_mask.astype(dtype)
 
     @staticmethod
     def extract_classes(seg_mask):
-        """从分割掩码中提取类别ID"""
+        """从分割掩码中提取类别ID，同时返回唯一值、逆索引和像素计数供后续复用"""
         if seg_mask is None:
-            return []
+            return [], None, None, None
+
+        # 小范围非负整数标签：bincount一次计数，无需排序；此时不需要逆索引
+        if (seg_mask.dtype.kind in 'iu' and seg_mask.size
+                and seg_mask.min() >= 0 and seg_mask.max() < BINCOUNT_MAX_LABEL):
+            counts = np.bincount(seg_mask.ravel(order='K').astype(np.intp, copy=False))
+            unique_ids = np.nonzero(counts)[0].astype(seg_mask.dtype)
+            class_ids = [id for id in unique_ids if id != 0]
+            return class_ids, unique_ids, None, counts[unique_ids]
 
-        unique_ids = np.unique(seg_mask)
+        unique_ids, inverse, counts = np.unique(seg_mask, return_inverse=True, return_counts=True)
         # 排除背景(假设0是背景)
-        return [id for id in unique_ids if id != 0]
+        class_ids = [id for id in unique_ids if id != 0]
+        return class_ids, unique_ids, inverse.reshape(seg_mask.shape), counts
+
+    @staticmethod
+    def filter_classes(original_mask, unique_ids, inverse, kept_ids):
+        """只保留kept_ids中的类别，其余置为0，返回新的掩码"""
+        if kept_ids.size == 0:
+            return np.zeros_like(original_mask)
+
+        if (NUMBA_AVAILABLE and original_mask.size > NUMBA_MIN_SIZE
+                and original_mask.dtype.kind in 'iu'
+                and unique_ids[0] >= 0 and unique_ids[-1] < BINCOUNT_MAX_LABEL):
+            # 大尺寸、标签范围较小的非负整数掩码：并行内核一次完成查找与写出
+            # （标签范围很大时查找表过大，改用下方的逆索引gather）
+            keep_lut = np.zeros(int(unique_ids[-1]) + 1, dtype=np.bool_)
+            keep_lut[kept_ids] = True
+            # 按内存顺序展平（MATLAB数据通常为F顺序，此时ravel为视图）
+            order = 'F' if np.isfortran(original_mask) else 'C'
+            flat_out = np.empty(original_mask.size, dtype=original_mask.dtype)
+            _filter_mask_numba(original_mask.ravel(order=order), keep_lut, flat_out)
+            return flat_out.reshape(original_mask.shape, order=order)
+
+        if inverse is None:
+            # 非负整数标签：按标签值查找表一次gather完成
+            lut = np.zeros(int(unique_ids[-1]) + 1, dtype=original_mask.dtype)
+            lut[kept_ids] = kept_ids
+            return lut[original_mask]
+
+        # 每个唯一值对应的输出标签，通过逆索引一次gather完成
+        keep_per_id = np.where(np.isin(unique_ids, kept_ids), unique_ids, 0)
+        return keep_per_id.astype(original_mask.dtype, copy=False)[inverse]
 
 
 class MatLoader(QThread):
@@ -98,35 +380,29 @@ class MatLoader(QThread):
     def __init__(self, file_path):
         super().__init__()
         self.file_path = file_path
+        self.file_mtime = None
         self.mat_data = None
+        self.mat_data_complete = False
         self.seg_mask = None
+        self.orig_dtype = None
         self.class_ids = []
+        self.unique_ids = None
+        self.inverse = None
+        self.class_counts = None
         self.source_info = ""
+        self.index_path = None
 
     def run(self):
         try:
             self.progress_updated.emit(f"正在加载文件: {os.path.basename(self.file_path)}")
 
-            # 加载MAT文件
-            self.mat_data = loadmat(self.file_path)
+            # 加载MAT文件（优先只加载候选变量），记录修改时间供保存时校验
+            self.file_mtime = os.path.getmtime(self.file_path)
+            self.mat_data, self.mat_data_complete = MatProcessor.load_candidates(self.file_path)
             self.progress_updated.emit("成功加载MAT文件")
 
             # 尝试提取分割掩码（使用用户提供的逻辑）
-            success = False
-
-            # 1. 尝试自定义处理器（沿用用户代码）
-            self.seg_mask, self.source_info = MatProcessor.custom_segmentation_processor(self.mat_data)
-            if self.seg_mask is not None:
-                self.progress_updated.emit(f"使用自定义处理器提取到分割掩码: {self.source_info}")
-                success = True
-
-            # 2. 如果失败，尝试通用方法（沿用用户代码）
-            if not success:
-                self.progress_updated.emit("尝试通用方法提取分割掩码")
-                self.seg_mask, self.source_info = MatProcessor.find_segmentation_mask(self.mat_data)
-                if self.seg_mask is not None:
-                    self.progress_updated.emit(f"使用通用方法提取到分割掩码: {self.source_info}")
-                    success = True
+            success = self.extract_mask()
 
             # 检查是否成功提取
             if not success or self.seg_mask is None:
@@ -138,10 +414,20 @@ class MatLoader(QThread):
                 self.load_failed.emit(f"分割掩码格式无效，形状: {getattr(self.seg_mask, 'shape', '未知')}")
                 return
 
+            # 空掩码没有可显示和编辑的内容
+            if self.seg_mask.size == 0:
+                self.load_failed.emit(f"分割掩码为空，形状: {self.seg_mask.shape}")
+                return
+
+            # 压缩标签类型，保存时再还原为原始类型
+            self.orig_dtype = self.seg_mask.dtype
+            self.seg_mask = MatProcessor.compact_labels(self.seg_mask)
+
             self.progress_updated.emit(f"提取到分割掩码，形状: {self.seg_mask.shape}, 类型: {self.seg_mask.dtype}")
 
             # 提取类别ID
-            self.class_ids = MatProcessor.extract_classes(self.seg_mask)
+            self.class_ids, self.unique_ids, self.inverse, self.class_counts = \
+                MatProcessor.extract_classes(self.seg_mask)
             self.progress_updated.emit(f"找到 {len(self.class_ids)} 个类别")
 
             # 发送加载完成信号
@@ -150,6 +436,70 @@ class MatLoader(QThread):
         except Exception as e:
             self.load_failed.emit(f"加载数据出错: {str(e)}")
 
+    def extract_mask(self):
+        """依次尝试自定义处理器和通用方法提取分割掩码"""
+        # 1. 尝试自定义处理器（沿用用户代码）
+        self.seg_mask, self.source_info, self.index_path = \
+            MatProcessor.custom_segmentation_processor(self.mat_data)
+        if self.seg_mask is not None:
+            self.progress_updated.emit(f"使用自定义处理器提取到分割掩码: {self.source_info}")
+            return True
+
+        # 2. 如果失败，尝试通用方法（沿用用户代码）
+        self.progress_updated.emit("尝试通用方法提取分割掩码")
+        self.seg_mask, self.source_info, self.index_path = MatProcessor.find_segmentation_mask(self.mat_data)
+        if self.seg_mask is not None:
+            self.progress_updated.emit(f"使用通用方法提取到分割掩码: {self.source_info}")
+            return True
+
+        return False
+
+
+class ApplyWorker(QThread):
+    """后台按类别选择过滤掩码的线程"""
+    result_ready = pyqtSignal(object)
+    apply_failed = pyqtSignal(str)
+
+    def __init__(self, original_mask, unique_ids, inverse, kept_ids):
+        super().__init__()
+        self.original_mask = original_mask
+        self.unique_ids = unique_ids
+        self.inverse = inverse
+        self.kept_ids = kept_ids
+
+    def run(self):
+        try:
+            self.result_ready.emit(MatProcessor.filter_classes(
+                self.original_mask, self.unique_ids, self.inverse, self.kept_ids))
+        except Exception as e:
+            self.apply_failed.emit(f"应用选择出错: {str(e)}")
+
+
+class MaskView(QLabel):
+    """以QPixmap显示RGBA掩码图像，窗口缩放时按比例重新缩放"""
+
+    def __init__(self):
+        super().__init__()
+        self._pixmap = None
+        self.setAlignment(Qt.AlignCenter)
+        self.setMinimumSize(200, 150)
+
+    def set_rgba(self, rgba):
+        """显示(H, W, 4)的uint8 RGBA数组"""
+        height, width = rgba.shape[:2]
+        image = QImage(rgba.data, width, height, 4 * width, QImage.Format_RGBA8888)
+        # fromImage会复制数据，之后不再依赖rgba的缓冲区
+        self._pixmap = QPixmap.fromImage(image)
+        self._update_scaled()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._update_scaled()
+
+    def _update_scaled(self):
+        if self._pixmap is not None:
+            self.setPixmap(self._pixmap.scaled(self.size(), Qt.KeepAspectRatio, Qt.FastTransformation))
+
 
 class MatSegmentEditor(QMainWindow):
     """MAT文件分割掩码编辑界面"""
@@ -157,13 +507,22 @@ class MatSegmentEditor(QMainWindow):
     def __init__(self):
         super().__init__()
         self.mat_file = None
+        self._file_mtime = None
         self.mat_data = None
+        self.mat_data_complete = False
         self.seg_mask = None
         self.original_mask = None
+        self._orig_dtype = None
+        self._label_colors = None
         self.class_ids = []
+        self.unique_ids = None
+        self.inverse = None
+        self.class_counts = {}
         self.class_names = []
         self.keep_status = []
+        self._last_applied = None
         self.source_info = ""
+        self._index_path = None
 
         self.init_ui()
 
@@ -256,15 +615,15 @@ class MatSegmentEditor(QMainWindow):
         # 原始图像
         original_group = QGroupBox("原始分割掩码")
         original_layout = QVBoxLayout(original_group)
-        self.original_canvas = FigureCanvas(plt.figure(figsize=(6, 4), dpi=100))
-        original_layout.addWidget(self.original_canvas)
+        self.original_view = MaskView()
+        original_layout.addWidget(self.original_view)
         img_splitter.addWidget(original_group)
 
         # 处理后图像
         processed_group = QGroupBox("处理后分割掩码")
         processed_layout = QVBoxLayout(processed_group)
-        self.processed_canvas = FigureCanvas(plt.figure(figsize=(6, 4), dpi=100))
-        processed_layout.addWidget(self.processed_canvas)
+        self.processed_view = MaskView()
+        processed_layout.addWidget(self.processed_view)
         img_splitter.addWidget(processed_group)
 
         right_layout.addWidget(img_splitter)
@@ -277,6 +636,33 @@ class MatSegmentEditor(QMainWindow):
         self.setStatusBar(self.statusBar)
         self.statusBar.showMessage("就绪")
 
+    @staticmethod
+    def _downsample(mask, max_side=DISPLAY_MAX_SIDE):
+        """最近邻步进降采样用于显示（返回视图，不复制数据）"""
+        step = max(1, max(mask.shape[:2]) // max_side)
+        return mask[::step, ::step]
+
+    def palette_index(self, values):
+        """按原始掩码的取值范围把标签值映射为调色板索引，两幅图颜色一致"""
+        vmin, vmax = float(self.unique_ids[0]), float(self.unique_ids[-1])
+        scale = 256 / (vmax - vmin) if vmax > vmin else 0
+        return np.clip((values - vmin) * scale, 0, 255).astype(np.uint8)
+
+    def update_view(self, view, mask):
+        """把掩码查表转换为RGBA并显示"""
+        disp = self._downsample(mask)
+        if disp.ndim == 3:
+            # 三维掩码显示第一个通道
+            disp = disp[..., 0]
+        # 步进视图不连续，显式复制一次，查表时按顺序读取
+        disp = np.ascontiguousarray(disp)
+
+        if self._label_colors is not None:
+            rgba = self._label_colors[disp]
+        else:
+            rgba = PALETTE[self.palette_index(disp)]
+        view.set_rgba(rgba)
+
     def load_mat_file(self):
         """加载MAT文件对话框"""
         file_path, _ = QFileDialog.getOpenFileName(
@@ -307,17 +693,28 @@ class MatSegmentEditor(QMainWindow):
         """加载完成处理"""
         # 保存加载的数据
         self.mat_data = mat_data
+        self.mat_data_complete = self.loader.mat_data_complete
         self.mat_file = self.loader.file_path
-        self.seg_mask = seg_mask.copy()
-        self.original_mask = seg_mask.copy()
+        self._file_mtime = self.loader.file_mtime
+        # 加载的数组可能与读取缓存共享，只读使用不复制；seg_mask只通过重新赋值修改，可与original_mask共享
+        self.original_mask = seg_mask
+        self.seg_mask = self.original_mask
+        self._orig_dtype = self.loader.orig_dtype
         self.class_ids = class_ids
         self.source_info = source_info
+        self._index_path = self.loader.index_path
+
+        # 复用加载线程中np.unique的结果
+        self.unique_ids = self.loader.unique_ids
+        self.inverse = self.loader.inverse
+        self.class_counts = dict(zip(self.unique_ids.tolist(), self.loader.class_counts.tolist()))
 
         # 生成类别名称
         self.class_names = [f"类别 {id}" for id in self.class_ids]
 
         # 初始化保留状态（默认保留所有类别）
         self.keep_status = [True] * len(self.class_ids)
+        self._last_applied = tuple(self.keep_status)
 
         # 更新界面
         self.populate_class_list()
@@ -336,15 +733,31 @@ class MatSegmentEditor(QMainWindow):
         QMessageBox.critical(self, "加载失败", error_message)
         self.update_status(f"加载失败: {error_message}")
 
+    @contextmanager
+    def batch_class_list_updates(self):
+        """批量修改类别列表期间暂停重绘和信号"""
+        self.class_list.setUpdatesEnabled(False)
+        self.class_list.blockSignals(True)
+        try:
+            yield
+        finally:
+            self.class_list.blockSignals(False)
+            self.class_list.setUpdatesEnabled(True)
+
     def populate_class_list(self):
         """填充类别列表"""
-        self.class_list.clear()
-
+        # 先构建全部条目，再在批量模式下一次性加入列表
+        items = []
         for i, (class_id, class_name) in enumerate(zip(self.class_ids, self.class_names)):
-            item = QListWidgetItem(f"ID {class_id}: {class_name}")
+            item = QListWidgetItem(f"ID {class_id}: {class_name} ({self.class_counts.get(class_id, 0)} 像素)")
             item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
             item.setCheckState(Qt.Checked if self.keep_status[i] else Qt.Unchecked)
-            self.class_list.addItem(item)
+            items.append(item)
+
+        with self.batch_class_list_updates():
+            self.class_list.clear()
+            for item in items:
+                self.class_list.addItem(item)
 
     def update_info_text(self):
         """更新信息文本"""
@@ -352,76 +765,85 @@ class MatSegmentEditor(QMainWindow):
             f"文件路径: {os.path.basename(self.mat_file)}",
             f"掩码来源: {self.source_info}",
             f"掩码形状: {self.seg_mask.shape}",
-            f"数据类型: {self.seg_mask.dtype}",
+            f"数据类型: {self.seg_mask.dtype} (原始: {self._orig_dtype})",
             f"类别数量: {len(self.class_ids)}"
         ]
         self.info_text.setText("\n".join(info))
 
     def display_images(self):
         """显示原始和处理后的图像"""
+        # 非负整数标签：预先计算每个标签值的颜色，显示时一次gather
+        if self.inverse is None:
+            self._label_colors = PALETTE[self.palette_index(np.arange(int(self.unique_ids[-1]) + 1))]
+        else:
+            self._label_colors = None
+
         # 显示原始图像
-        self.original_canvas.figure.clear()
-        ax_original = self.original_canvas.figure.add_subplot(111)
-        ax_original.imshow(self.original_mask, cmap='viridis')
-        ax_original.set_title("原始分割掩码")
-        ax_original.axis('off')
-        self.original_canvas.figure.tight_layout()
-        self.original_canvas.draw()
+        self.update_view(self.original_view, self.original_mask)
 
         # 初始显示处理后的图像（与原始相同）
-        self.processed_canvas.figure.clear()
-        ax_processed = self.processed_canvas.figure.add_subplot(111)
-        ax_processed.imshow(self.seg_mask, cmap='viridis')
-        ax_processed.set_title("处理后分割掩码")
-        ax_processed.axis('off')
-        self.processed_canvas.figure.tight_layout()
-        self.processed_canvas.draw()
+        self.update_view(self.processed_view, self.seg_mask)
 
     def apply_selection(self):
         """应用类别选择"""
+        current = tuple(self.class_list.item(i).checkState() == Qt.Checked
+                        for i in range(self.class_list.count()))
+
+        # 与上次应用的选择相同时无需重新计算
+        if current == self._last_applied:
+            self.update_status("无变化")
+            return
+
         # 更新保留状态
-        for i in range(self.class_list.count()):
-            item = self.class_list.item(i)
-            self.keep_status[i] = (item.checkState() == Qt.Checked)
+        self.keep_status = list(current)
+
+        # 在后台线程中创建处理后的掩码（保留选中的类别）
+        kept_ids = np.asarray([cid for cid, keep in zip(self.class_ids, self.keep_status) if keep],
+                              dtype=self.original_mask.dtype)
+        self.set_apply_running(True)
+        self.update_status("正在应用选择...")
+
+        self.apply_worker = ApplyWorker(self.original_mask, self.unique_ids, self.inverse, kept_ids)
+        self.apply_worker.result_ready.connect(self.on_apply_finished)
+        self.apply_worker.apply_failed.connect(self.on_apply_failed)
+        self.apply_worker.start()
 
-        # 创建处理后的掩码
-        processed_mask = np.zeros_like(self.original_mask)
+    def set_apply_running(self, running):
+        """后台应用期间禁用会修改掩码的按钮"""
+        for btn in (self.load_btn, self.save_btn, self.apply_btn, self.reset_btn):
+            btn.setEnabled(not running)
 
-        # 保留选中的类别
-        for i, (class_id, keep) in enumerate(zip(self.class_ids, self.keep_status)):
-            if keep:
-                processed_mask[self.original_mask == class_id] = class_id
+    def on_apply_finished(self, processed_mask):
+        """应用选择完成处理"""
+        self.set_apply_running(False)
+        self._last_applied = tuple(self.keep_status)
 
         # 更新显示
         self.seg_mask = processed_mask
-        self.processed_canvas.figure.clear()
-        ax_processed = self.processed_canvas.figure.add_subplot(111)
-        ax_processed.imshow(self.seg_mask, cmap='viridis')
-        ax_processed.set_title("处理后分割掩码")
-        ax_processed.axis('off')
-        self.processed_canvas.figure.tight_layout()
-        self.processed_canvas.draw()
+        self.update_view(self.processed_view, self.seg_mask)
 
         self.update_status(f"已应用选择，保留 {sum(self.keep_status)} 个类别")
 
+    def on_apply_failed(self, error_message):
+        """应用选择失败处理"""
+        self.set_apply_running(False)
+        QMessageBox.critical(self, "应用失败", error_message)
+        self.update_status(f"应用失败: {error_message}")
+
     def reset_selection(self):
         """重置选择"""
         # 重置保留状态
         self.keep_status = [True] * len(self.class_ids)
+        self._last_applied = tuple(self.keep_status)
 
         # 重置复选框
-        for i in range(self.class_list.count()):
-            self.class_list.item(i).setCheckState(Qt.Checked)
+        with self.batch_class_list_updates():
+            for i in range(self.class_list.count()):
+                self.class_list.item(i).setCheckState(Qt.Checked)
 
         # 重置掩码
-        self.seg_mask = self.original_mask.copy()
-        self.processed_canvas.figure.clear()
-        ax_processed = self.processed_canvas.figure.add_subplot(111)
-        ax_processed.imshow(self.seg_mask, cmap='viridis')
-        ax_processed.set_title("处理后分割掩码")
-        ax_processed.axis('off')
-        self.processed_canvas.figure.tight_layout()
-        self.processed_canvas.draw()
+        self.seg_mask = self.original_mask
+        self.update_view(self.processed_view, self.seg_mask)
 
         self.update_status("已重置所有选择")
 
@@ -447,41 +869,38 @@ class MatSegmentEditor(QMainWindow):
             return
 
         try:
-            # 根据分割掩码来源更新MAT数据
-            if self.source_info.startswith("GTinst.") or self.source_info.startswith("GTcls."):
-                # 处理GTinst/GTcls结构中的Segmentation字段
-                struct_name = self.source_info.split('.')[0]
-                field_name = self.source_info.split('.')[1]
-
-                # 确保数据格式正确
-                if self.mat_data[struct_name].ndim == 2 and self.mat_data[struct_name].shape == (1, 1):
-                    # 标准SBD格式
-                    if field_name in self.mat_data[struct_name][0, 0].dtype.names:
-                        # 保持原有结构不变，只更新数据
-                        original_field = self.mat_data[struct_name][0, 0][field_name]
-
-                        # 检查原始数据的维度结构
-                        if original_field.ndim >= 2 and original_field.shape[0] == 1 and original_field.shape[1] == 1:
-                            # 嵌套结构: [[data]]
-                            self.mat_data[struct_name][0, 0][field_name][0, 0] = self.seg_mask
-                        elif original_field.ndim == 2 and original_field.shape[0] == 1:
-                            # 结构: [data]
-                            self.mat_data[struct_name][0, 0][field_name][0] = self.seg_mask
-                        else:
-                            # 直接替换
-                            self.mat_data[struct_name][0, 0][field_name] = self.seg_mask
-                    else:
-                        raise ValueError(f"结构 {struct_name} 中找不到字段 {field_name}")
-                else:
-                    raise ValueError(f"结构 {struct_name} 格式不符合预期")
-
+            # 还原为加载时的数据类型，避免改变下游使用的MAT结构
+            save_mask = self.seg_mask.astype(self._orig_dtype, copy=False)
+
+            # 沿加载时记录的索引路径写回，保持原有结构不变，只更新数据
+            # （加载的数据可能与读取缓存共享，只复制路径上的容器）
+            self.mat_data = MatProcessor.replace_at_path(self.mat_data, self._index_path, save_mask)
+
+            # 加载时只读取了候选变量，保存前从源文件补齐其余未修改的变量
+            if not self.mat_data_complete:
+                if os.path.getmtime(self.mat_file) != self._file_mtime:
+                    raise ValueError("源文件在加载后已被修改，无法补齐未加载的变量，请重新加载后再保存")
+                var_names = [name for name, _, _ in whosmat(self.mat_file)]
+                remaining = [name for name in var_names if name not in self.mat_data]
+                if remaining:
+                    self.mat_data.update(loadmat(self.mat_file, variable_names=remaining))
+
+                # 按源文件中的变量顺序写出
+                ordered = {k: v for k, v in self.mat_data.items() if k.startswith('__')}
+                ordered.update((name, self.mat_data[name]) for name in var_names if name in self.mat_data)
+                self.mat_data = ordered
+                self.mat_data_complete = True
+
+            # 保存修改后的MAT文件（大掩码用HDF5分块压缩写出，小文件用savemat更快）
+            if HDF5STORAGE_AVAILABLE and save_mask.nbytes > HDF5_MIN_NBYTES:
+                # hdf5storage按精确类型查找写出方法，不接受np.memmap，转为普通数组视图（不复制）
+                variables = {k: np.asarray(v) if isinstance(v, np.memmap) else v
+                             for k, v in self.mat_data.items() if not k.startswith('__')}
+                # 覆盖已存在的目标文件，而不是以追加方式打开
+                hdf5storage.savemat(save_path, variables, format='7.3', matlab_compatible=True,
+                                    compress=True, truncate_existing=True)
             else:
-                # 直接更新变量
-                var_name = self.source_info.split('.')[0]
-                self.mat_data[var_name] = self.seg_mask
-
-            # 保存修改后的MAT文件
-            savemat(save_path, self.mat_data)
+                savemat(save_path, self.mat_data)
 
             # 显示保存成功消息
             QMessageBox.information(self, "保存成功", f"已成功保存到:\n{save_path}")